@@ -16,6 +16,8 @@ parser.add_argument('--yr1', type=int, required=True, help='Start year for the a
 parser.add_argument('--yr2', type=int, required=True, help='End year for the analysis')
 parser.add_argument('--outdir', type=str, required=True, help='Output directory for results')
 parser.add_argument('--pmp_data_root', type=str, required=True, help='Path to PMP data root')
+parser.add_argument('--vars', type=str, nargs='+', default=None, help='Subset of CMOR variables to process (default: all)')
+parser.add_argument('--param_file', type=str, default='param.py', help='Path of the PMP parameter file to write')
 args = parser.parse_args()
 
 # Step 1: Define directories and parameters
@@ -25,8 +27,10 @@ yr1 = args.yr1
 yr2 = args.yr2
 outdir = args.outdir
 pmp_data_root = args.pmp_data_root
+param_file = args.param_file
 
 # Define GFDL to CMOR variable mapping
+# (keep `default_vars` in work_queue.py in sync with the entries mapped to a GFDL name)
 varmap = {
     "hur": None,
     "hurs": None,
@@ -59,6 +63,10 @@ varmap = {
 
 varmap = {k: v for k, v in varmap.items() if v is not None}
 
+# restrict to the requested variables (e.g. one variable per work-queue task)
+if args.vars is not None:
+    varmap = {k: v for k, v in varmap.items() if k in args.vars}
+
 tcoord = "time"
 
 # Step 3: Aggregate the files into a single xarray DataSet
@@ -211,7 +219,7 @@ parameters = {
 }
 
 # save the parameters to a .py file (would be cleaner to somehow invoke PMP directly)
-with open("param.py", "w") as f:
+with open(param_file, "w") as f:
     for k, v in parameters.items():
         if isinstance(v, str):
             f.write(f"{k} = '{v}'\n")
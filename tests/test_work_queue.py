@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+import multiprocessing
+
+import pytest
+
+import work_queue
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "work_queue.py")
+
+
+def run_workers(queue_dir, nprocs, stale_timeout=300.0):
+    """Drain the queue with `nprocs` concurrent work() processes"""
+    workers = [
+        multiprocessing.Process(target=work_queue.work, args=(queue_dir, stale_timeout, 0.1, 0.05))
+        for _ in range(nprocs)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+            worker.join()
+    assert [worker.exitcode for worker in workers] == [0] * nprocs
+
+
+def states(queue_dir):
+    paths = work_queue.queue_paths(queue_dir)
+    return {task["id"]: work_queue.task_state(paths, task["id"]) for task in work_queue.load_tasks(paths)}
+
+
+def test_workers_run_each_task_once(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    for i in range(20):
+        work_queue.add_task(queue_dir, f"t{i:02d}", ["sh", "-c", f"echo $$ >> ran.{i}; sleep 0.1"], str(tmp_path))
+    work_queue.add_task(queue_dir, "last", ["sh", "-c", "echo x >> ran.last"], str(tmp_path),
+                        deps=[f"t{i:02d}" for i in range(20)])
+
+    run_workers(queue_dir, 6)
+
+    assert set(states(queue_dir).values()) == {"done"}
+    for i in list(range(20)) + ["last"]:
+        with open(tmp_path / f"ran.{i}") as f:
+            assert len(f.readlines()) == 1
+    assert os.listdir(os.path.join(queue_dir, "claims")) == []
+
+
+def test_failed_dependency_propagates(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    cwd = str(tmp_path)
+    work_queue.add_task(queue_dir, "ok", ["sh", "-c", "true"], cwd)
+    work_queue.add_task(queue_dir, "bad", ["sh", "-c", "exit 3"], cwd)
+    work_queue.add_task(queue_dir, "child", ["sh", "-c", "echo x > child"], cwd, deps=["bad"])
+    work_queue.add_task(queue_dir, "grandchild", ["sh", "-c", "true"], cwd, deps=["child"])
+    work_queue.add_task(queue_dir, "partial", ["sh", "-c", "true"], cwd, deps=["ok", "bad"], partial=True)
+    work_queue.add_task(queue_dir, "all_failed", ["sh", "-c", "true"], cwd, deps=["bad"], partial=True)
+
+    run_workers(queue_dir, 3)
+
+    assert states(queue_dir) == {
+        "all_failed": "failed",
+        "bad": "failed",
+        "child": "failed",
+        "grandchild": "failed",
+        "ok": "done",
+        "partial": "done",
+    }
+    assert not os.path.exists(tmp_path / "child")
+
+
+def test_dead_claim_is_requeued(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    paths = work_queue.queue_paths(queue_dir)
+    work_queue.add_task(queue_dir, "local", ["sh", "-c", "echo x >> ran.local"], str(tmp_path))
+    work_queue.add_task(queue_dir, "remote", ["sh", "-c", "echo x >> ran.remote"], str(tmp_path))
+
+    # claim from a process that no longer exists on this host
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    token = dict(work_queue.new_token(), pid=dead.pid)
+    assert work_queue.try_claim(os.path.join(paths["claims"], "local.lock"), token)
+
+    # claim from another host whose heartbeat stopped
+    token = dict(work_queue.new_token(), host="othernode")
+    lockfile = os.path.join(paths["claims"], "remote.lock")
+    assert work_queue.try_claim(lockfile, token)
+    os.utime(lockfile, (0, 0))
+
+    run_workers(queue_dir, 2, stale_timeout=10.0)
+
+    assert set(states(queue_dir).values()) == {"done"}
+    for name in ["local", "remote"]:
+        with open(tmp_path / f"ran.{name}") as f:
+            assert len(f.readlines()) == 1
+
+
+def test_live_claim_is_kept(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    paths = work_queue.queue_paths(queue_dir)
+    lockfile = os.path.join(paths["claims"], "t.lock")
+    work_queue.add_task(queue_dir, "t", ["true"], str(tmp_path))
+
+    token = dict(work_queue.new_token(), host="othernode")
+    assert work_queue.try_claim(lockfile, token)
+    assert not work_queue.requeue_stale(lockfile, 10.0)
+    assert work_queue.owns_claim(lockfile, token)
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def test_task_dies_with_its_worker(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    # the first run blocks, the re-run finishes at once
+    cmd = "echo $$ >> ran; [ -e started ] && exit 0; touch started; sleep 60"
+    work_queue.add_task(queue_dir, "t", ["sh", "-c", cmd], str(tmp_path))
+
+    args = [sys.executable, script, "--queue_dir", queue_dir, "work", "--poll", "0.05", "--heartbeat", "0.1"]
+    first = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+    wait_for(lambda: os.path.exists(tmp_path / "started"))
+    first.kill()
+    first.wait()
+
+    with open(tmp_path / "ran") as f:
+        orphan = int(f.read())
+    wait_for(lambda: not work_queue.pid_alive(orphan))
+
+    second = subprocess.run(args, stdout=subprocess.DEVNULL, timeout=60)
+
+    assert second.returncode == 0
+    assert states(queue_dir) == {"t": "done"}
+
+
+def test_killed_worker_under_nprocs_is_collected(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    for name in ["a", "b"]:
+        cmd = f"echo $PPID > worker.{name}; [ -e started.{name} ] && exit 0; touch started.{name}; sleep 1"
+        work_queue.add_task(queue_dir, name, ["sh", "-c", cmd], str(tmp_path))
+
+    args = [sys.executable, script, "--queue_dir", queue_dir, "work", "--nprocs", "2",
+            "--poll", "0.05", "--heartbeat", "0.1"]
+    parent = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+    try:
+        wait_for(lambda: all(os.path.exists(tmp_path / f"started.{name}") for name in ["a", "b"]))
+        workers = []
+        for name in ["a", "b"]:
+            with open(tmp_path / f"worker.{name}") as f:
+                workers.append(int(f.read()))
+        assert len(set(workers)) == 2
+
+        # the worker started last is not the one the parent would join first
+        os.kill(max(workers), signal.SIGKILL)
+        assert parent.wait(timeout=30) == 0
+    finally:
+        parent.kill()
+        parent.wait()
+
+    assert states(queue_dir) == {"a": "done", "b": "done"}
+    assert os.listdir(os.path.join(queue_dir, "claims")) == []
+
+
+def test_unknown_dependency_fails(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    work_queue.add_task(queue_dir, "t", ["sh", "-c", "true"], str(tmp_path), deps=["missing"])
+
+    run_workers(queue_dir, 1)
+
+    assert states(queue_dir) == {"t": "failed"}
+    with open(os.path.join(queue_dir, "failed", "t")) as f:
+        assert f.read() == "unknown dependency missing\n"
+
+
+def test_enqueue_pipeline(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    ppdir = tmp_path / "pp"
+    ppdir.mkdir()
+    for filename in ["atmos.198001-198412.pr.nc", "atmos.198501-198912.pr.nc",
+                     "atmos.198001-198912.tas.nc", "atmos.195001-195912.psl.nc"]:
+        (ppdir / filename).touch()
+    outdir = str(tmp_path / "out")
+
+    added = work_queue.enqueue_pipeline(queue_dir, [("exp1", str(ppdir))], 1980, 2014, outdir,
+                                        "/pmp", "AMIP", work_queue.default_vars)
+
+    paths = work_queue.queue_paths(queue_dir)
+    tasks = {task["id"]: task for task in work_queue.load_tasks(paths)}
+    # psl has no files in the analysis period
+    assert added == 6
+    assert sorted(tasks) == ["exp1.clim.pr", "exp1.clim.tas", "exp1.figure", "exp1.html",
+                             "exp1.metrics.pr", "exp1.metrics.tas"]
+
+    expdir = os.path.join(outdir, "exp1") + "/"
+    for var in ["pr", "tas"]:
+        clim = tasks[f"exp1.clim.{var}"]
+        assert clim["deps"] == []
+        assert clim["cmd"][clim["cmd"].index("--vars") + 1] == var
+        param_file = clim["cmd"][clim["cmd"].index("--param_file") + 1]
+        assert param_file == f"{expdir}param_{var}.py"
+
+        metrics = tasks[f"exp1.metrics.{var}"]
+        assert metrics["deps"] == [f"exp1.clim.{var}"]
+        assert metrics["cmd"][-1] == param_file
+
+    assert tasks["exp1.figure"]["deps"] == ["exp1.metrics.pr", "exp1.metrics.tas"]
+    assert tasks["exp1.figure"]["partial"] is True
+    assert tasks["exp1.html"]["deps"] == ["exp1.figure"]
+    assert tasks["exp1.html"]["partial"] is False
+
+    # re-enqueuing only adds missing tasks
+    assert work_queue.enqueue_pipeline(queue_dir, [("exp1", str(ppdir))], 1980, 2014, outdir,
+                                       "/pmp", "AMIP", work_queue.default_vars) == 0
+
+
+def test_enqueue_pipeline_rejects_unsupported_vars(tmp_path):
+    with pytest.raises(ValueError):
+        work_queue.enqueue_pipeline(str(tmp_path / "queue"), [], 1980, 2014, str(tmp_path),
+                                    "/pmp", "AMIP", ["pr", "hur"])
+
+
+def test_add_task_is_idempotent(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    assert work_queue.add_task(queue_dir, "t", ["true"], str(tmp_path))
+    assert not work_queue.add_task(queue_dir, "t", ["false"], str(tmp_path), deps=["x"])
+
+    with open(os.path.join(queue_dir, "tasks", "t.json")) as f:
+        task = json.load(f)
+    assert task["cmd"] == ["true"]
+    assert task["deps"] == []
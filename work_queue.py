@@ -0,0 +1,501 @@
+import os
+import sys
+import glob
+import json
+import time
+import ctypes
+import signal
+import uuid
+import socket
+import argparse
+import functools
+import subprocess
+import multiprocessing
+
+# Directory holding the pipeline scripts, used to build the task commands
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# CMOR variables handled by generate_pmp_metrics.py (keys of its `varmap`
+# that map to a GFDL name); keep both lists in sync
+default_vars = [
+    "pr", "prw", "psl", "rlds", "rlus", "rlut", "rlutcs", "rsds", "rsdscs",
+    "rsdt", "rsus", "rsut", "rsutcs", "sfcWind", "ta", "tas", "tauu", "tauv",
+    "ua", "va", "zg",
+]
+
+# Sub-directories of the shared queue directory
+#   tasks/  : one json spec per task
+#   claims/ : lock file per task currently being worked on
+#   done/   : marker per successfully completed task
+#   failed/ : marker per failed task
+#   logs/   : stdout/stderr of each task
+queue_subdirs = ["tasks", "claims", "done", "failed", "logs"]
+
+
+def queue_paths(queue_dir):
+    """Create (if needed) and return the sub-directories of the queue"""
+    paths = {name: os.path.join(queue_dir, name) for name in queue_subdirs}
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+    return paths
+
+
+def write_atomic(filename, text):
+    """Write a file so that readers on other nodes never see it half written"""
+    tmpfile = f"{filename}.tmp.{socket.gethostname()}.{os.getpid()}"
+    with open(tmpfile, "w") as f:
+        f.write(text)
+    os.replace(tmpfile, filename)
+
+
+def add_task(queue_dir, task_id, cmd, cwd, deps=(), partial=False):
+    """Add a task to the queue
+
+    Parameters
+    ----------
+    queue_dir : str
+        Shared queue directory
+    task_id : str
+        Unique name of the task, also used as its file name
+    cmd : list
+        Command to execute
+    cwd : str
+        Working directory of the command
+    deps : list
+        Task ids that must complete before this task can be claimed
+    partial : bool
+        If True, the task also runs when some (but not all) of `deps` failed
+
+    Returns
+    -------
+    bool
+        True if the task was added, False if it was already queued
+    """
+    paths = queue_paths(queue_dir)
+    task_file = os.path.join(paths["tasks"], f"{task_id}.json")
+    if os.path.exists(task_file):
+        return False
+    task = {"id": task_id, "cmd": list(cmd), "cwd": cwd, "deps": list(deps), "partial": partial}
+    write_atomic(task_file, json.dumps(task, indent=2))
+    return True
+
+
+def load_tasks(paths):
+    """Read all task specs, sorted by id"""
+    tasks = []
+    for task_file in sorted(glob.glob(os.path.join(paths["tasks"], "*.json"))):
+        with open(task_file) as f:
+            tasks.append(json.load(f))
+    return tasks
+
+
+def task_state(paths, task_id):
+    """Return 'done', 'failed', 'claimed' or 'pending' for a task"""
+    if os.path.exists(os.path.join(paths["done"], task_id)):
+        return "done"
+    if os.path.exists(os.path.join(paths["failed"], task_id)):
+        return "failed"
+    if os.path.exists(os.path.join(paths["claims"], f"{task_id}.lock")):
+        return "claimed"
+    return "pending"
+
+
+def try_claim(lockfile, token):
+    """Atomically create the lock file; only one worker can succeed"""
+    try:
+        fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(json.dumps(token))
+    return True
+
+
+def read_token(lockfile):
+    """Return the owner recorded in a lock file, or None if unreadable"""
+    try:
+        with open(lockfile) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def new_token():
+    """Return the owner record of a new claim, with a unique claim id"""
+    return {"host": socket.gethostname(), "pid": os.getpid(), "claim": uuid.uuid4().hex}
+
+
+def owns_claim(lockfile, token):
+    """Check that the lock file still holds the claim described by `token`"""
+    current = read_token(lockfile)
+    return current is not None and current.get("claim") == token["claim"]
+
+
+def pid_alive(pid):
+    """Check whether a running (non-zombie) process with this PID exists on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    # a killed worker stays a zombie until its parent collects it
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+    except (OSError, IndexError):
+        return True
+    return state not in ("Z", "X")
+
+
+def is_stale(lockfile, token, stale_timeout):
+    """Determine if a claim belongs to a dead worker
+
+    A claim is stale when its heartbeat (the lock file mtime) is older than
+    `stale_timeout` seconds. A claim made on this host is also stale as soon
+    as neither the worker nor the task process it started is running.
+    """
+    try:
+        age = time.time() - os.stat(lockfile).st_mtime
+    except FileNotFoundError:
+        return False
+    if age > stale_timeout:
+        return True
+
+    if token is not None and token.get("host") == socket.gethostname():
+        pids = [token["pid"]] + ([token["child"]] if "child" in token else [])
+        return not any(pid_alive(pid) for pid in pids)
+    return False
+
+
+def requeue_stale(lockfile, stale_timeout):
+    """Release a stale claim so the task can be claimed again
+
+    The lock is first renamed to a unique name, which only one worker can do,
+    and its claim id is compared with the one judged stale. If the task was
+    re-claimed in between, the live claim is linked back in place. Should a
+    third worker claim the task in that short window, the link fails and the
+    moved claim is left as is; its owner then finds its claim gone at the
+    next heartbeat and stops its run, so the task is not completed twice.
+
+    Returns
+    -------
+    bool
+        True if the stale claim was removed
+    """
+    token = read_token(lockfile)
+    if not is_stale(lockfile, token, stale_timeout):
+        return False
+    moved = f"{lockfile}.stale.{socket.gethostname()}.{os.getpid()}"
+    try:
+        os.rename(lockfile, moved)
+    except FileNotFoundError:
+        return False
+    if read_token(moved) != token:
+        # a fresh claim was taken before the rename; give it back
+        try:
+            os.link(moved, lockfile)
+        except FileExistsError:
+            pass
+        os.remove(moved)
+        return False
+    os.remove(moved)
+    return True
+
+
+def die_with_worker(worker_pid):
+    """Have the task process killed when its worker dies (Linux only)
+
+    Runs in the task process between fork and exec. Only the task process
+    itself is covered, not processes it starts in turn.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.prctl(1, signal.SIGKILL)  # PR_SET_PDEATHSIG
+    # the worker may have died before the death signal was armed
+    if os.getppid() != worker_pid:
+        os.kill(os.getpid(), signal.SIGKILL)
+
+
+def run_task(paths, task, lockfile, token, heartbeat_interval):
+    """Execute a claimed task and record the outcome
+
+    While the task runs, the lock file mtime is refreshed every
+    `heartbeat_interval` seconds. If the claim was taken over by another
+    worker, the task is killed and no outcome is recorded. On Linux, the task
+    is also killed if the worker dies, so a re-queued claim never overlaps
+    a still running orphan. On other platforms it can.
+
+    Returns
+    -------
+    int or None
+        Return code of the task command, None if the claim was lost
+    """
+    task_id = task["id"]
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    logfile = os.path.join(paths["logs"], f"{task_id}.log")
+    print(f"[{worker}] running {task_id}")
+
+    with open(logfile, "w") as log:
+        try:
+            preexec_fn = functools.partial(die_with_worker, os.getpid()) if sys.platform.startswith("linux") else None
+            proc = subprocess.Popen(task["cmd"], cwd=task["cwd"], stdout=log, stderr=subprocess.STDOUT,
+                                    preexec_fn=preexec_fn)
+        except OSError as exception:
+            log.write(f"{exception}\n")
+            proc = None
+            returncode = 127
+
+        if proc is not None:
+            # record the task process so the claim can be checked on this host
+            write_atomic(lockfile, json.dumps(dict(token, child=proc.pid)))
+            while True:
+                try:
+                    returncode = proc.wait(timeout=heartbeat_interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if not owns_claim(lockfile, token):
+                    print(f"[{worker}] lost the claim on {task_id}, stopping it")
+                    proc.kill()
+                    proc.wait()
+                    return None
+                os.utime(lockfile)
+
+    if not owns_claim(lockfile, token):
+        print(f"[{worker}] lost the claim on {task_id}, discarding its result")
+        return None
+
+    status = "done" if returncode == 0 else "failed"
+    write_atomic(os.path.join(paths[status], task_id), f"{returncode}\n")
+    print(f"[{worker}] {task_id} {status} (return code {returncode})")
+    os.remove(lockfile)
+    return returncode
+
+
+def dependency_state(task, states):
+    """Return 'ready', 'waiting' or 'failed' for the dependencies of a task
+
+    A partial task runs once all its dependencies have finished and at least
+    one of them is done; it fails only when all of them failed. Dependencies
+    that are not in the queue count as failed.
+    """
+    dep_states = [states.get(dep, "failed") for dep in task["deps"]]
+    if task.get("partial", False):
+        if any(state not in ("done", "failed") for state in dep_states):
+            return "waiting"
+        if dep_states and "done" not in dep_states:
+            return "failed"
+        return "ready"
+    if "failed" in dep_states:
+        return "failed"
+    if any(state != "done" for state in dep_states):
+        return "waiting"
+    return "ready"
+
+
+def work(queue_dir, stale_timeout=300.0, heartbeat_interval=30.0, poll_interval=5.0):
+    """Claim and execute tasks until every task is done or failed
+
+    Any number of workers, on any node sharing `queue_dir`, can run this
+    concurrently. Tasks whose dependencies failed are marked as failed
+    without being executed.
+
+    Returns
+    -------
+    int
+        Number of tasks this worker executed
+    """
+    paths = queue_paths(queue_dir)
+    executed = 0
+
+    while True:
+        tasks = load_tasks(paths)
+        states = {task["id"]: task_state(paths, task["id"]) for task in tasks}
+        if all(state in ("done", "failed") for state in states.values()):
+            return executed
+
+        claimed = False
+        for task in tasks:
+            task_id = task["id"]
+            if states[task_id] in ("done", "failed"):
+                continue
+
+            lockfile = os.path.join(paths["claims"], f"{task_id}.lock")
+            if states[task_id] == "claimed" and not requeue_stale(lockfile, stale_timeout):
+                continue
+
+            deps = dependency_state(task, states)
+            if deps == "waiting":
+                continue
+
+            token = new_token()
+            if not try_claim(lockfile, token):
+                continue
+            claimed = True
+
+            # another worker may have finished it between the scan and the claim
+            if task_state(paths, task_id) != "claimed":
+                os.remove(lockfile)
+            elif deps == "failed":
+                missing = [dep for dep in task["deps"] if dep not in states]
+                reason = f"unknown dependency {', '.join(missing)}" if missing else "dependency failed"
+                write_atomic(os.path.join(paths["failed"], task_id), f"{reason}\n")
+                os.remove(lockfile)
+            elif run_task(paths, task, lockfile, token, heartbeat_interval) is not None:
+                executed += 1
+            break
+
+        if not claimed:
+            time.sleep(poll_interval)
+
+
+def status(queue_dir):
+    """Print a summary of the queue and return the number of failed tasks"""
+    paths = queue_paths(queue_dir)
+    counts = {"pending": 0, "claimed": 0, "done": 0, "failed": 0}
+    for task in load_tasks(paths):
+        state = task_state(paths, task["id"])
+        counts[state] += 1
+        if state in ("claimed", "failed"):
+            print(f"{state:>8}  {task['id']}")
+    print(", ".join(f"{k}: {v}" for k, v in counts.items()))
+    return counts["failed"]
+
+
+def is_in_range(filepath, yr1, yr2):
+    """Same year-range check as in generate_pmp_metrics.py"""
+    filename = os.path.split(filepath)[-1]
+    years = filename.split(".")[1].split("-")
+    years = [int(x[0:4]) for x in years]
+    return not ((years[1] < int(yr1)) or (years[0] > int(yr2)))
+
+
+def read_experiments(filename):
+    """Read `DESCRIPTOR PPDIR` pairs, one per line ('#' starts a comment)"""
+    experiments = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                descriptor, ppdir = line.split()
+                experiments.append((descriptor, ppdir))
+    return experiments
+
+
+def enqueue_pipeline(queue_dir, experiments, yr1, yr2, outdir, pmp_data_root, convention, varlist):
+    """Queue the PMP pipeline for each experiment, split by variable
+
+    For every experiment and variable, a climatology task
+    (generate_pmp_metrics.py) and a metrics task (mean_climate_driver.py) are
+    queued. The portrait plot and html tasks of an experiment run once all of
+    its metrics tasks have finished, using the variables that succeeded.
+    Results go to `{outdir}/{descriptor}/`.
+    """
+    unsupported = sorted(set(varlist) - set(default_vars))
+    if unsupported:
+        raise ValueError(f"Unsupported variables: {', '.join(unsupported)}")
+
+    added = 0
+    for descriptor, ppdir in experiments:
+        expdir = os.path.join(os.path.abspath(outdir), descriptor) + "/"
+        os.makedirs(expdir, exist_ok=True)
+
+        metrics_tasks = []
+        for var in varlist:
+            # skip variables without any output in the analysis period
+            files = glob.glob(f"{ppdir}/*.{var}.nc")
+            if not any(is_in_range(x, yr1, yr2) for x in files):
+                continue
+
+            param_file = f"{expdir}param_{var}.py"
+            clim_task = f"{descriptor}.clim.{var}"
+            added += add_task(
+                queue_dir, clim_task,
+                ["python", f"{script_dir}/generate_pmp_metrics.py", "--ppdir", ppdir,
+                 "--descriptor", descriptor, "--yr1", str(yr1), "--yr2", str(yr2),
+                 "--outdir", expdir, "--pmp_data_root", pmp_data_root,
+                 "--vars", var, "--param_file", param_file],
+                expdir,
+            )
+
+            metrics_task = f"{descriptor}.metrics.{var}"
+            added += add_task(
+                queue_dir, metrics_task,
+                ["mean_climate_driver.py", "--save_test_clims", "False", "-p", param_file],
+                expdir,
+                deps=[clim_task],
+            )
+            metrics_tasks.append(metrics_task)
+
+        if not metrics_tasks:
+            print(f"No variables found for {descriptor} in {ppdir}")
+            continue
+
+        figure_task = f"{descriptor}.figure"
+        added += add_task(
+            queue_dir, figure_task,
+            ["python", f"{script_dir}/portrait_plot.py", "--pmp_data_root", pmp_data_root,
+             "--convention", convention, "--outdir", expdir],
+            expdir,
+            deps=metrics_tasks,
+            partial=True,
+        )
+
+        added += add_task(
+            queue_dir, f"{descriptor}.html",
+            ["python", f"{script_dir}/html_generate.py", "--descriptor", descriptor,
+             "--convention", convention, "--outdir", expdir],
+            expdir,
+            deps=[figure_task],
+        )
+    return added
+
+
+if __name__ == "__main__":
+
+    # Parse input arguments
+    parser = argparse.ArgumentParser(description="Shared-filesystem work queue for batch PMP evaluations.")
+    parser.add_argument('--queue_dir', type=str, required=True, help='Shared queue directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    enqueue_parser = subparsers.add_parser('enqueue', help='Queue the pipeline tasks for a set of experiments')
+    enqueue_parser.add_argument('--experiments', type=str, required=True, help='File listing "DESCRIPTOR PPDIR" per line')
+    enqueue_parser.add_argument('--yr1', type=int, required=True, help='Start year for the analysis')
+    enqueue_parser.add_argument('--yr2', type=int, required=True, help='End year for the analysis')
+    enqueue_parser.add_argument('--outdir', type=str, required=True, help='Output directory, one sub-directory per experiment')
+    enqueue_parser.add_argument('--pmp_data_root', type=str, required=True, help='Path to PMP data root')
+    enqueue_parser.add_argument('--convention', type=str, required=True, help='Convention of model simulation')
+    enqueue_parser.add_argument('--vars', type=str, nargs='+', default=default_vars, choices=default_vars, metavar='VAR', help='CMOR variables to process')
+
+    work_parser = subparsers.add_parser('work', help='Claim and run tasks until the queue is drained')
+    work_parser.add_argument('--nprocs', type=int, default=1, help='Number of worker processes to start on this node')
+    work_parser.add_argument('--stale_timeout', type=float, default=300.0, help='Seconds without heartbeat before a claim is re-queued')
+    work_parser.add_argument('--heartbeat', type=float, default=30.0, help='Seconds between heartbeats of a running task')
+    work_parser.add_argument('--poll', type=float, default=5.0, help='Seconds to wait when no task can be claimed')
+
+    subparsers.add_parser('status', help='Summarize the state of the queue')
+
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        experiments = read_experiments(args.experiments)
+        added = enqueue_pipeline(args.queue_dir, experiments, args.yr1, args.yr2, args.outdir,
+                                 args.pmp_data_root, args.convention, args.vars)
+        print(f"{added} tasks added to {args.queue_dir}")
+
+    elif args.command == "work":
+        work_args = (args.queue_dir, args.stale_timeout, args.heartbeat, args.poll)
+        if args.nprocs > 1:
+            workers = [multiprocessing.Process(target=work, args=work_args) for _ in range(args.nprocs)]
+            for worker in workers:
+                worker.start()
+            # collect workers as they exit so a killed one does not stay a zombie
+            while multiprocessing.active_children():
+                time.sleep(args.poll)
+        else:
+            work(*work_args)
+        sys.exit(1 if status(args.queue_dir) else 0)
+
+    elif args.command == "status":
+        status(args.queue_dir)